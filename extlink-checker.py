@@ -1,5 +1,7 @@
 #! /usr/bin/env python3
 
+import os.path
+
 import mwparserfromhell
 
 from ws.checkers import ExtlinkStatusChecker
@@ -28,7 +30,8 @@ if __name__ == "__main__":
 
     # create updater and add checkers
     updater = Updater.from_argparser(args)
-    checker = ExtlinkStatusChecker(updater.api, None, timeout=args.connection_timeout, max_retries=args.connection_max_retries)
+    checker = ExtlinkStatusChecker(updater.api, None, timeout=args.connection_timeout, max_retries=args.connection_max_retries,
+                                   cache_db_path=os.path.join(args.cache_dir, args.site + ".extlinks.sqlite"))
     updater.add_checker(mwparserfromhell.nodes.ExternalLink, checker)
 
     try:
@@ -1,5 +1,7 @@
 #! /usr/bin/env python3
 
+import os.path
+
 import mwparserfromhell
 
 from ws.client import API
@@ -49,7 +51,8 @@ if __name__ == "__main__":
 
     # create updater and add checkers
     updater = Updater.from_argparser(args, api)
-    checker = LinkChecker(api, db, timeout=args.connection_timeout, max_retries=args.connection_max_retries)
+    checker = LinkChecker(api, db, timeout=args.connection_timeout, max_retries=args.connection_max_retries,
+                          cache_db_path=os.path.join(args.cache_dir, args.site + ".extlinks.sqlite"))
     updater.add_checker(mwparserfromhell.nodes.ExternalLink, checker)
     updater.add_checker(mwparserfromhell.nodes.Wikilink, checker)
     updater.add_checker(mwparserfromhell.nodes.Template, checker)
@@ -6,7 +6,7 @@ import pytest
 import requests_mock
 
 from ws.client import API
-from ws.checkers import ExtlinkReplacements
+from ws.checkers import ExtlinkStatusChecker, ExtlinkReplacements
 
 # set up the global logger
 logging.basicConfig()
@@ -87,3 +87,15 @@ def extlink_replacements(api_mock):
         # put session_mock into the checker so that tests can register mocked responses
         checker.session_mock = session_mock
         yield checker
+
+
+# function-scoped for the same reason as above, but without the mocked API
+# (the checker needs only the localized template names, which are mocked)
+@pytest.fixture(scope="function")
+def extlink_status_checker(mocker):
+    checker = ExtlinkStatusChecker(None, None)
+    mocker.patch.object(checker, "get_localized_template", side_effect=lambda template, language="English": template)
+
+    with requests_mock.Mocker(session=checker.session) as session_mock:
+        checker.session_mock = session_mock
+        yield checker
@@ -4,6 +4,7 @@ import re
 
 from pytest_bdd import scenarios, given, when, then, parsers
 import mwparserfromhell
+import requests_mock
 
 from ws.pageupdater import PageUpdater
 
@@ -19,20 +20,20 @@ def set_site_url(extlink_replacements, site_url):
 @given(parsers.parse("these working URLs:\n{text}"))
 def mock_url_status_200(extlink_replacements, text):
     for url in text.splitlines():
-        extlink_replacements.session_mock.get(url, status_code=200)
+        extlink_replacements.session_mock.register_uri(requests_mock.ANY, url, status_code=200)
 
 @given(parsers.parse("these broken URLs:\n{text}"))
 def mock_url_status_404(extlink_replacements, text):
     for url in text.splitlines():
-        extlink_replacements.session_mock.get(url, status_code=404)
+        extlink_replacements.session_mock.register_uri(requests_mock.ANY, url, status_code=404)
 
 @given(parsers.parse("the URL {url} gives status {status:d}"))
 def mock_url_status(extlink_replacements, url, status):
-    extlink_replacements.session_mock.get(url, status_code=status)
+    extlink_replacements.session_mock.register_uri(requests_mock.ANY, url, status_code=status)
 
 @given(parsers.parse("the URL {url} redirects to {target_url}"))
 def mock_url_status(extlink_replacements, url, target_url):
-    extlink_replacements.session_mock.get(url, status_code=302, headers={"Location": target_url})
+    extlink_replacements.session_mock.register_uri(requests_mock.ANY, url, status_code=302, headers={"Location": target_url})
 
 
 @when(parsers.parse("a page contains \"{text}\""))
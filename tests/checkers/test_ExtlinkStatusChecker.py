@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+import collections
+import http.server
+import threading
+import time
+
+import pytest
+import mwparserfromhell
+import requests
+import requests_mock
+
+from ws.checkers.ExtlinkStatusChecker import ExtlinkStatusChecker
+
+
+def test_connection_pool():
+    checker = ExtlinkStatusChecker(None, None, num_pools=20, max_connections_per_host=7)
+    for url in ["https://x", "http://x"]:
+        poolmanager = checker.session.get_adapter(url).poolmanager
+        assert poolmanager.connection_pool_kw["maxsize"] == 7
+        assert poolmanager.connection_pool_kw["block"] is True
+
+def test_page_batch_check(extlink_status_checker):
+    mock = extlink_status_checker.session_mock
+    mock.register_uri(requests_mock.ANY, "http://example.com/good", status_code=200)
+    mock.register_uri(requests_mock.ANY, "http://example.org/good", status_code=200)
+    mock.register_uri(requests_mock.ANY, "http://example.com/bad", status_code=404)
+
+    wikicode = mwparserfromhell.parse("[http://example.com/good a] [http://example.com/bad b] "
+                                      "http://example.com/good http://example.org/good")
+    extlink_status_checker.prepare_page("Foo", wikicode)
+    requests_sent = mock.call_count
+    for extlink in wikicode.filter_external_links(recursive=True):
+        extlink_status_checker.handle_node("Foo", wikicode, extlink, [])
+
+    # all requests are sent by prepare_page, each URL is checked only once
+    # (the broken link is checked with HEAD and then with GET)
+    assert mock.call_count == requests_sent
+    urls = [(request.method, request.url) for request in mock.request_history]
+    assert sorted(urls) == [
+        ("GET", "http://example.com/bad"),
+        ("HEAD", "http://example.com/bad"),
+        ("HEAD", "http://example.com/good"),
+        ("HEAD", "http://example.org/good"),
+    ]
+
+    date = "|".join(extlink_status_checker.deadlink_params)
+    assert str(wikicode) == ("[http://example.com/good a] [http://example.com/bad b]{{Dead link|%s|status=404}} "
+                             "http://example.com/good http://example.org/good" % date)
+
+def make_checker(mocker, **kwargs):
+    checker = ExtlinkStatusChecker(None, None, **kwargs)
+    mocker.patch.object(checker, "get_localized_template", side_effect=lambda template, language="English": template)
+    return checker
+
+def check_page(checker, text):
+    wikicode = mwparserfromhell.parse(text)
+    checker.prepare_page("Foo", wikicode)
+    for extlink in wikicode.filter_external_links(recursive=True):
+        checker.handle_node("Foo", wikicode, extlink, [])
+    return str(wikicode)
+
+def register_urls(mock):
+    mock.register_uri(requests_mock.ANY, "http://example.com/good", status_code=200)
+    mock.register_uri(requests_mock.ANY, "http://example.com/bad", status_code=404)
+    mock.register_uri(requests_mock.ANY, "http://example.com/error", status_code=503)
+    mock.register_uri(requests_mock.ANY, "http://example.com/timeout", exc=requests.exceptions.ConnectTimeout)
+
+class test_cache_db:
+    text = "[http://example.com/good a] [http://example.com/bad b] [http://example.com/error c]"
+
+    def test_round_trip(self, mocker, tmp_path):
+        path = str(tmp_path / "extlinks.sqlite")
+
+        checker = make_checker(mocker, cache_db_path=path)
+        with requests_mock.Mocker(session=checker.session) as mock:
+            register_urls(mock)
+            text_new = check_page(checker, self.text + " [http://example.com/timeout d]")
+            assert mock.called
+        date = "|".join(checker.deadlink_params)
+        expected = "[http://example.com/good a] [http://example.com/bad b]{{Dead link|%s|status=404}} [http://example.com/error c]" % date
+        assert text_new == expected + " [http://example.com/timeout d]"
+
+        # connection errors are not stored
+        rows = checker.cache_db.execute("SELECT url, status, reason FROM url_status ORDER BY url").fetchall()
+        assert rows == [
+            ("http://example.com/bad", 0, "404"),
+            ("http://example.com/error", None, None),
+            ("http://example.com/good", 1, None),
+        ]
+
+        # a new checker loads the results from the database (including the
+        # indeterminate result) and the invalid status is still written into the flag
+        checker = make_checker(mocker, cache_db_path=path)
+        with requests_mock.Mocker(session=checker.session) as mock:
+            register_urls(mock)
+            assert check_page(checker, self.text) == expected
+            assert mock.call_count == 0
+            assert checker.check_url("http://example.com/timeout") is None
+            assert mock.call_count == 1
+
+    def test_max_age(self, mocker, tmp_path):
+        path = str(tmp_path / "extlinks.sqlite")
+
+        checker = make_checker(mocker, cache_db_path=path)
+        with requests_mock.Mocker(session=checker.session) as mock:
+            register_urls(mock)
+            check_page(checker, self.text)
+        # make the results older than cache_max_age
+        with checker.cache_db:
+            checker.cache_db.execute("UPDATE url_status SET checked_at = checked_at - 2 * 24 * 3600")
+
+        checker = make_checker(mocker, cache_db_path=path)
+        with requests_mock.Mocker(session=checker.session) as mock:
+            register_urls(mock)
+            assert checker.check_urls(["http://example.com/good", "http://example.com/error"]) == [True, None]
+            assert {request.url for request in mock.request_history} == {"http://example.com/good", "http://example.com/error"}
+
+@pytest.fixture(scope="function")
+def http_server():
+    """
+    Local HTTP server which records the peak number of concurrent requests
+    for each host name. (requests_mock cannot be used to test concurrency,
+    because it serializes all requests.)
+    """
+    lock = threading.Lock()
+    active = collections.Counter()
+    peak = collections.Counter()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            host = self.headers["Host"].split(":")[0]
+            with lock:
+                active[host] += 1
+                peak[host] = max(peak[host], active[host])
+            time.sleep(0.05)
+            with lock:
+                active[host] -= 1
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.peak = peak
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_host_request_limits(mocker, http_server):
+    checker = make_checker(mocker, max_requests_per_host=2)
+    mocker.patch.object(checker, "host_request_limits", {"localhost": 1})
+
+    port = http_server.server_address[1]
+    urls = ["http://127.0.0.1:{}/{}".format(port, i) for i in range(6)] + \
+           ["http://localhost:{}/{}".format(port, i) for i in range(3)]
+    assert checker.check_urls(urls) == [True] * len(urls)
+    assert http_server.peak == {"127.0.0.1": 2, "localhost": 1}
+
+class test_429:
+    url = "http://example.com/throttled"
+
+    def test_retry_after(self, extlink_status_checker, mocker):
+        sleep = mocker.patch("time.sleep")
+        extlink_status_checker.session_mock.register_uri(requests_mock.ANY, self.url, [
+            {"status_code": 429, "headers": {"Retry-After": "3"}},
+            {"status_code": 200},
+        ])
+        assert extlink_status_checker.check_url(self.url) is True
+        sleep.assert_called_once_with(3)
+        assert extlink_status_checker.session_mock.call_count == 2
+
+    def test_max_retry_after(self, extlink_status_checker, mocker):
+        sleep = mocker.patch("time.sleep")
+        extlink_status_checker.session_mock.register_uri(requests_mock.ANY, self.url, [
+            {"status_code": 429, "headers": {"Retry-After": "3600"}},
+            {"status_code": 200},
+        ])
+        assert extlink_status_checker.check_url(self.url) is True
+        sleep.assert_called_once_with(extlink_status_checker.max_retry_after)
+
+    def test_persisting(self, extlink_status_checker, mocker, caplog):
+        sleep = mocker.patch("time.sleep")
+        extlink_status_checker.session_mock.register_uri(requests_mock.ANY, self.url, status_code=429)
+        assert extlink_status_checker.check_url(self.url) is None
+        sleep.assert_called_once_with(extlink_status_checker.default_retry_after)
+        # HEAD and the retry, 429 from HEAD does not fall back to GET
+        assert [request.method for request in extlink_status_checker.session_mock.request_history] == ["HEAD", "HEAD"]
+
+        # the result is cached as indeterminate and logged only once
+        assert extlink_status_checker.check_url(self.url) is None
+        assert extlink_status_checker.session_mock.call_count == 2
+        warnings = [record for record in caplog.records if record.levelname == "WARNING" and "429" in record.getMessage()]
+        assert len(warnings) == 1
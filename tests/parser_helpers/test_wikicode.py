@@ -1,5 +1,6 @@
 #! /usr/bin/env python3
 
+import pytest
 import mwparserfromhell
 
 from ws.parser_helpers.wikicode import *
@@ -50,6 +51,17 @@ Some other text.
         parent = get_parent_wikicode(self.wikicode, link)
         assert str(parent) == str(note.params[0])
 
+    def test_nested_direct_child(self):
+        note = self.wikicode.filter_templates()[0]
+        link = self.wikicode.filter_wikilinks()[0]
+        parent = get_parent_wikicode(note.params[0].value, link)
+        assert parent is note.params[0].value
+
+    def test_not_found(self):
+        other = mwparserfromhell.parse("[[wikipedia:reference]]").get(0)
+        with pytest.raises(ValueError):
+            get_parent_wikicode(self.wikicode, other)
+
 class test_remove_and_squash:
     @staticmethod
     def _do_test(wikicode, remove, expected):
@@ -0,0 +1,17 @@
+#! /usr/bin/env python3
+
+import ssl
+
+from ws.utils import TLSAdapter
+
+def test_pool_parameters():
+    adapter = TLSAdapter(pool_connections=5, pool_maxsize=7, pool_block=True)
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 7
+    assert adapter.poolmanager.connection_pool_kw["block"] is True
+    pool = adapter.poolmanager.connection_from_url("https://example.com")
+    assert pool.pool.maxsize == 7
+
+def test_ssl_options():
+    adapter = TLSAdapter(ssl_options=ssl.OP_NO_TLSv1)
+    ctx = adapter.poolmanager.connection_pool_kw["ssl_context"]
+    assert ctx.options & ssl.OP_NO_TLSv1
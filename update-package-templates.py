@@ -4,6 +4,9 @@ import os.path
 import datetime
 import json
 import logging
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import mwparserfromhell
@@ -15,7 +18,7 @@ from ws.utils import LazyProperty
 from ws.interactive import edit_interactive, require_login, InteractiveQuit
 from ws.autopage import AutoPage
 from ws.ArchWiki.lang import detect_language, format_title
-from ws.parser_helpers.wikicode import get_parent_wikicode, ensure_flagged_by_template, ensure_unflagged_by_template
+from ws.parser_helpers.wikicode import get_parent_wikicode, ensure_flagged_by_template, ensure_unflagged_by_template, parented_ifilter
 from ws.parser_helpers.title import canonicalize
 
 logger = logging.getLogger(__name__)
@@ -67,6 +70,22 @@ class PkgFinder:
 
         self.aurpkgs = None
         self.pacdb = self.pacdb_init(PACCONF, os.path.join(self.tmpdir, "pacdbpath"), arch="x86_64")
+        # names of packages and groups in the sync databases, populated by pacdb_index
+        # (the dicts map lowercase names to the actual names)
+        self.pkgnames = set()
+        self.pkgnames_lower = {}
+        self.grpnames = set()
+        self.grpnames_lower = {}
+        # packages indexed by the names in their `replaces` arrays, populated by pacdb_index
+        self.replaces = {}
+        self.replaces_lower = {}
+
+        # the same package names are looked up on many pages, so the results
+        # are cached until the next refresh
+        self.find_pkg = functools.lru_cache(maxsize=None)(self._find_pkg)
+        self.find_grp = functools.lru_cache(maxsize=None)(self._find_grp)
+        self.find_aur = functools.lru_cache(maxsize=None)(self._find_aur)
+        self.find_replaces = functools.lru_cache(maxsize=None)(self._find_replaces)
 
     def pacdb_init(self, config, dbpath, arch):
         os.makedirs(dbpath, exist_ok=True)
@@ -79,9 +98,12 @@ class PkgFinder:
 
     # sync database of AUR packages
     def aurpkgs_refresh(self, aurpkgs_url):
-        response = requests.get(aurpkgs_url)
-        response.raise_for_status()
-        self.aurpkgs = set(line for line in response.text.splitlines() if not line.startswith("#"))
+        # stream the response to avoid holding the whole decompressed list as one string
+        with requests.get(aurpkgs_url, stream=True) as response:
+            response.raise_for_status()
+            if response.encoding is None:
+                response.encoding = "utf-8"
+            self.aurpkgs = frozenset(line for line in response.iter_lines(decode_unicode=True) if line and not line.startswith("#"))
 
     # sync databases like pacman -Sy
     def pacdb_refresh(self, pacdb, force=False):
@@ -89,13 +111,44 @@ class PkgFinder:
             # since this is private pacman database, there is no locking
             db.update(force)
 
+    # build the lookup tables of package and group names
+    def pacdb_index(self, pacdb):
+        self.pkgnames = set()
+        self.pkgnames_lower = {}
+        self.grpnames = set()
+        self.grpnames_lower = {}
+        self.replaces = {}
+        self.replaces_lower = {}
+        # the first match wins, so the repositories are processed in the same order as in pacman.conf
+        for db in pacdb.get_syncdbs():
+            for pkg in db.pkgcache:
+                self.pkgnames.add(pkg.name)
+                self.pkgnames_lower.setdefault(pkg.name.lower(), pkg.name)
+                for replaced in pkg.replaces:
+                    self.replaces.setdefault(replaced, pkg)
+                    self.replaces_lower.setdefault(replaced.lower(), pkg)
+            for grp in db.grpcache:
+                self.grpnames.add(grp[0])
+                self.grpnames_lower.setdefault(grp[0].lower(), grp[0])
+
+    # drop cached results of the find_* methods
+    def cache_clear(self):
+        for method in [self.find_pkg, self.find_grp, self.find_aur, self.find_replaces]:
+            method.cache_clear()
+
     # sync all
     def refresh(self):
+        self.cache_clear()
         try:
-            logger.info("Syncing AUR packages...")
-            self.aurpkgs_refresh(self.aurpkgs_url)
-            logger.info("Syncing pacman database...")
-            self.pacdb_refresh(self.pacdb)
+            # both downloads are independent, so they are done concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                logger.info("Syncing AUR packages...")
+                aur_future = executor.submit(self.aurpkgs_refresh, self.aurpkgs_url)
+                logger.info("Syncing pacman database...")
+                pacdb_future = executor.submit(self.pacdb_refresh, self.pacdb)
+                for future in [aur_future, pacdb_future]:
+                    future.result()
+            self.pacdb_index(self.pacdb)
             return True
         except requests.exceptions.RequestException:
             logger.exception("Failed to download %s" % self.aurpkgs_url)
@@ -104,52 +157,43 @@ class PkgFinder:
             logger.exception("Failed to sync pacman database.")
             return False
 
-    # try to find given package (in either 32bit or 64bit database)
-    def find_pkg(self, pkgname, exact=True):
+    # try to find given package in the sync databases
+    def _find_pkg(self, pkgname, exact=True):
+        if exact is False:
+            # translate to the exact name (db.get_pkg does only exact match)
+            pkgname = self.pkgnames_lower.get(pkgname.lower())
+        if pkgname not in self.pkgnames:
+            return None
         for db in self.pacdb.get_syncdbs():
-            if exact is True:
-                pkg = db.get_pkg(pkgname)
-                if pkg is not None and pkg.name == pkgname:
-                    return pkg
-            else:
-                # iterate over all packages (db.get_pkg does only exact match)
-                for pkg in db.pkgcache:
-                    # compare pkgnames in lowercase
-                    if pkg.name.lower() == pkgname.lower():
-                        return pkg
+            pkg = db.get_pkg(pkgname)
+            if pkg is not None and pkg.name == pkgname:
+                return pkg
         return None
 
-    # try to find given group (in either 32bit or 64bit database)
-    def find_grp(self, grpname, exact=True):
+    # try to find given group in the sync databases
+    def _find_grp(self, grpname, exact=True):
+        if exact is False:
+            # translate to the exact name (db.read_grp does only exact match)
+            grpname = self.grpnames_lower.get(grpname.lower())
+        if grpname not in self.grpnames:
+            return None
         for db in self.pacdb.get_syncdbs():
-            if exact is True:
-                grp = db.read_grp(grpname)
-                if grp is not None and grp[0] == grpname:
-                    return grp
-            else:
-                # iterate over all groups (db.read_grp does only exact match)
-                for grp in db.grpcache:
-                    if grp[0].lower() == grpname.lower():
-                        return grp
+            grp = db.read_grp(grpname)
+            if grp is not None and grp[0] == grpname:
+                return grp
         return None
 
     # check that given package exists in AUR
-    def find_aur(self, pkgname):
+    def _find_aur(self, pkgname):
         # all packages in AUR are strictly lowercase, but queries both via web (links) and helpers are case-insensitive
         pkgname = pkgname.lower()
         return pkgname in self.aurpkgs
 
     # try to find a package that has given pkgname in its `replaces` array
-    def find_replaces(self, pkgname, exact=True):
-        for db in self.pacdb.get_syncdbs():
-            # iterate over all packages (search like pacman -Ss is not enough when
-            # the pkgname is not proper keyword)
-            for pkg in db.pkgcache:
-                if exact is True and pkgname in pkg.replaces:
-                    return pkg
-                elif exact is False and pkgname.lower() in (_pkgname.lower() for _pkgname in pkg.replaces):
-                    return pkg
-        return None
+    def _find_replaces(self, pkgname, exact=True):
+        if exact is True:
+            return self.replaces.get(pkgname)
+        return self.replaces_lower.get(pkgname.lower())
 
 
 class PkgUpdater:
@@ -165,6 +209,12 @@ class PkgUpdater:
         "CVE",
     ]
 
+    # canonical names of the templates updated by this script
+    package_templates = {"Aur", "AUR", "Grp", "Pkg"}
+    # loose pattern for finding pages which may contain some of the package templates
+    # (false positives are filtered out later in update_page)
+    package_templates_regex = re.compile(r"\{\{[\s_]*(aur|grp|pkg)", re.IGNORECASE)
+
     def __init__(self, api, aurpkgs_url, tmpdir, report_dir, report_page, interactive=False):
         self.api = api
         self.finder = PkgFinder(aurpkgs_url, tmpdir)
@@ -334,35 +384,42 @@ class PkgUpdater:
         logger.info("Parsing page [[{}]]...".format(title))
         lang = detect_language(title)[1]
         wikicode = mwparserfromhell.parse(text)
-        for template in wikicode.ifilter_templates():
+        # the direct parent of each template is tracked during the iteration so that
+        # the helper functions below do not have to search the whole page for it
+        for parent, template in parented_ifilter(wikicode, recursive=True, forcetype=mwparserfromhell.nodes.Template):
             # skip unrelated templates
-            if not any(template.name.matches(tmp) for tmp in ["Aur", "AUR", "Grp", "Pkg"]):
+            # (canonicalize the name only once, template.name.matches would parse each candidate)
+            if canonicalize(template.name.strip_code()) not in self.package_templates:
                 continue
 
             # skip templates no longer under wikicode (templates nested under previously
             # removed parent template are still detected by ifilter)
-            try:
-                wikicode.index(template, True)
-            except ValueError:
-                continue
+            # (top-level templates are never removed, so only nested templates have to be checked)
+            if parent is not wikicode:
+                try:
+                    wikicode.index(template, True)
+                except ValueError:
+                    continue
 
             # strip whitespace around the parameter, otherwise it is added to
             # the link and rendered incorrectly
-            self.strip_whitespace(wikicode, template)
+            self.strip_whitespace(parent, template)
 
             hint = self.update_package_template(template, lang)
 
             # add/remove/update {{Broken package link}} flag
             if hint is not None:
-                logger.warning("broken package link: {}: {}".format(template, hint))
-                self.add_report_line(title, template, hint)
+                # serialize the template only once
+                template_repr = str(template)
+                logger.warning("broken package link: {}: {}".format(template_repr, hint))
+                self.add_report_line(title, template_repr, hint)
                 # first unflag since the localized template might change
-                ensure_unflagged_by_template(wikicode, template, "Broken package link", match_only_prefix=True)
+                ensure_unflagged_by_template(parent, template, "Broken package link", match_only_prefix=True)
                 # flag with a localized template and hint
                 flag = self.get_localized_template("Broken package link", lang)
-                ensure_flagged_by_template(wikicode, template, flag, hint, overwrite_parameters=True)
+                ensure_flagged_by_template(parent, template, flag, hint, overwrite_parameters=True)
             else:
-                ensure_unflagged_by_template(wikicode, template, "Broken package link", match_only_prefix=True)
+                ensure_unflagged_by_template(parent, template, "Broken package link", match_only_prefix=True)
 
         return wikicode
 
@@ -374,27 +431,46 @@ class PkgUpdater:
         require_login(self.api)
 
         namespaces = [0, 4, 14, 3000]
-        for ns in namespaces:
-            for page in self.api.generator(generator="allpages", gaplimit="100", gapfilterredir="nonredirects", gapnamespace=ns,
-                                           prop="revisions", rvprop="content|timestamp", rvslots="main"):
-                title = page["title"]
-                if title in self.blacklist_pages:
-                    logger.info("skipping blacklisted page [[{}]]".format(title))
-                    continue
-                timestamp = page["revisions"][0]["timestamp"]
-                text_old = page["revisions"][0]["slots"]["main"]["*"]
-                text_new = self.update_page(title, text_old)
-                if text_old != text_new:
-                    try:
+        # Non-interactive edits are submitted from a separate thread so that the
+        # parsing of the following pages overlaps with the rate-limited API.edit
+        # calls. At most one edit is pending at a time, which keeps the memory
+        # usage bounded and propagates exceptions raised by the edit thread.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending_edit = None
+            for ns in namespaces:
+                for page in self.api.generator(generator="allpages", gaplimit="100", gapfilterredir="nonredirects", gapnamespace=ns,
+                                               prop="revisions", rvprop="content|timestamp", rvslots="main"):
+                    title = page["title"]
+                    if title in self.blacklist_pages:
+                        logger.info("skipping blacklisted page [[{}]]".format(title))
+                        continue
+                    timestamp = page["revisions"][0]["timestamp"]
+                    text_old = page["revisions"][0]["slots"]["main"]["*"]
+                    # skip parsing pages which certainly do not contain any package template
+                    if not self.package_templates_regex.search(text_old):
+                        continue
+                    text_new = str(self.update_page(title, text_old))
+                    if text_old != text_new:
                         if self.interactive:
-                            edit_interactive(self.api, title, page["pageid"], text_old, text_new, timestamp, self.edit_summary, bot="")
+                            try:
+                                edit_interactive(self.api, title, page["pageid"], text_old, text_new, timestamp, self.edit_summary, bot="")
+                            except APIError:
+                                pass
                         else:
-                            self.api.edit(title, page["pageid"], text_new, timestamp, self.edit_summary, bot="")
-                    except APIError:
-                        pass
+                            if pending_edit is not None:
+                                pending_edit.result()
+                            pending_edit = executor.submit(self._edit, title, page["pageid"], text_new, timestamp)
+            if pending_edit is not None:
+                pending_edit.result()
+
+    def _edit(self, title, pageid, text_new, timestamp):
+        try:
+            self.api.edit(title, pageid, text_new, timestamp, self.edit_summary, bot="")
+        except APIError:
+            pass
 
-    def add_report_line(self, title, template, message):
-        message = "<nowiki>{}</nowiki> ({})".format(template, message)
+    def add_report_line(self, title, template_repr, message):
+        message = "<nowiki>{}</nowiki> ({})".format(template_repr, message)
         lang = detect_language(title)[1]
         if lang not in self.log:
             self.log[lang] = {}
@@ -72,5 +72,13 @@ class CheckerBase:
         # fall back to English
         return template
 
+    def prepare_page(self, src_title, wikicode):
+        """
+        Called once for each page before :py:meth:`handle_node` is called for
+        its nodes. Checkers can override this method to do page-level work,
+        e.g. to batch network requests for all nodes on the page.
+        """
+        pass
+
     def handle_node(self, src_title, wikicode, node, summary_parts):
         raise NotImplementedError("the handle_node method was not implemented in the derived class")
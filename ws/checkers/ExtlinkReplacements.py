@@ -287,10 +287,10 @@ class ExtlinkReplacements(ExtlinkStatusChecker):
                 #   - gitlab gives 302 to the master branch instead of 404 for non-existent files/directories
                 if new_url.startswith("https://gitlab.archlinux.org"):
                     # use same query as ExtlinkStatusChecker.check_url
-                    response = self.session.get(new_url, headers=self.headers, timeout=self.timeout, stream=True, allow_redirects=True)
-                    # explicitly close the responses to release the connection back to the pool
+                    response = self.session.get(new_url, timeout=self.timeout, stream=True, allow_redirects=True)
+                    # explicitly release the connection back to the pool
                     # (this is important, especially when we use pool_block=True)
-                    response.close()
+                    self.release_response(response)
                     if len(response.history) > 0:
                         if response.url.endswith("/master"):
                             # this is gitlab's "404" in most cases
@@ -365,6 +365,10 @@ class ExtlinkReplacements(ExtlinkStatusChecker):
         with summary("update http to https"):
             self.check_http_to_https(wikicode, extlink, url)
 
+    def prepare_page(self, src_title, wikicode):
+        # this checker checks only the replaced URLs, not all links on the page
+        pass
+
     def handle_node(self, src_title, wikicode, node, summary_parts):
         if isinstance(node, mwparserfromhell.nodes.ExternalLink):
             self.update_extlink(wikicode, node, summary_parts)
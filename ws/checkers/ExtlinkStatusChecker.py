@@ -1,14 +1,21 @@
 #! /usr/bin/env python3
 
 # TODO:
-# - cache the status results in the database, limit the number of checks per URL per day (and week/month too)
+# - limit the number of checks per URL per week/month too (the persistent cache limits only the checks per day)
 # - GRRR: When you get 404, unless you have Javascript enabled, in which case the code loaded on the 404 page might execute a redirection to a different address. Example: https://nzbget.net/Performance_tips
-# - handle 429 (Too Many Requests), often returned by archive.is
 
 import logging
 import datetime
+import email.utils
+import re
 import ipaddress
+import itertools
 import ssl
+import sqlite3
+import threading
+import time
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 
 import mwparserfromhell
 import requests
@@ -26,12 +33,36 @@ logger = logging.getLogger(__name__)
 
 
 class ExtlinkStatusChecker(CheckerBase):
+    # maximum size (in bytes) of response bodies which are read to keep the connection alive
+    max_drain_size = 64 * 1024
+
+    # cheap pre-filter for prepare_url: URLs which do not start with a http(s) scheme
+    # and a host containing a dot would be skipped anyway (not applied to URLs with
+    # HTML entities, which are matched only after normalization)
+    url_prefilter_regex = re.compile(r"^https?://[^\s/]+\.[^\s/]", re.IGNORECASE)
+
+    # maximum number of concurrent requests for specific hosts (overrides max_requests_per_host)
+    host_request_limits = {
+        # archive.is returns 429 (Too Many Requests) very often
+        "archive.is": 1,
+        "archive.ph": 1,
+        "archive.today": 1,
+    }
+    # delay (in seconds) before retrying a request which got 429 without a valid Retry-After header
+    default_retry_after = 5
+    # maximum delay (in seconds) before retrying a request which got 429
+    max_retry_after = 60
+
     def __init__(self, api, db, *, timeout=60, max_retries=3,
-                 num_pools=100, max_connections_per_host=10,
+                 num_pools=100, max_connections_per_host=10, max_workers=20,
+                 max_requests_per_host=4,
+                 cache_db_path=None, cache_max_age=datetime.timedelta(days=1),
                  **kwargs):
         super().__init__(api, db, **kwargs)
 
         self.timeout = timeout
+        # number of threads used by check_urls
+        self.max_workers = max_workers
         self.session = requests.Session()
         adapter_params = {
             "max_retries": max_retries,
@@ -53,6 +84,8 @@ class ExtlinkStatusChecker(CheckerBase):
             # fake user agent to bypass servers responding differently or not at all to non-browser user agents
             "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.116 Safari/537.36",
         }
+        # set the headers on the session so that they are used for all requests
+        self.session.headers.update(self.headers)
 
         # valid URLs - 2xx, 3xx (when allow_redirects=True)
         self.cache_valid_urls = set()
@@ -60,32 +93,66 @@ class ExtlinkStatusChecker(CheckerBase):
         self.cache_invalid_urls = {}
         # indeterminate - 5xx, 3xx (when allow_redirects=False)
         self.cache_indeterminate_urls = set()
+        # hosts which do not handle HEAD requests properly, only GET requests are used for them
+        self.hosts_without_head = set()
+
+        # semaphores limiting the number of concurrent requests per host
+        self.max_requests_per_host = max_requests_per_host
+        self.host_semaphores = {}
+        self.host_semaphores_lock = threading.Lock()
+
+        # futures of the URLs which are being checked, see _check_url
+        self.inflight_urls = {}
+        self.inflight_urls_lock = threading.Lock()
 
+        # statuses of the URLs checked by prepare_page for the current page
+        # (including the results which are not cached, e.g. timeouts)
+        self.page_url_statuses = {}
+
+        # persistent cache of the URL status results (shared across runs)
+        self.cache_max_age = cache_max_age
+        self.cache_db = None
+        if cache_db_path is not None:
+            self.cache_db_init(cache_db_path)
+
+        # (date, params) tuple for the deadlink_params property
+        self._deadlink_params_cache = (None, None)
+
+    @property
+    def deadlink_params(self):
+        """
+        The date parameters for the ``{{Dead link}}`` template, as a tuple of
+        zero-padded strings. They are recomputed only when the (UTC) date
+        changes, so runs crossing midnight do not use a stale date.
+        """
         now = datetime.datetime.utcnow()
-        self.deadlink_params = [now.year, now.month, now.day]
-        self.deadlink_params = ["{:02d}".format(i) for i in self.deadlink_params]
+        date, params = self._deadlink_params_cache
+        if date != now.date():
+            params = tuple("{:02d}".format(i) for i in [now.year, now.month, now.day])
+            self._deadlink_params_cache = (now.date(), params)
+        return params
 
     def prepare_url(self, wikicode, extlink):
-        # make a copy of the URL object (the skip_style_flags parameter is False,
-        # so we will also properly parse URLs terminated by a wiki markup)
-        url = mwparserfromhell.parse(str(extlink.url))
+        # skip obviously unsupported URLs (e.g. mailto: or ftp:// links) before parsing
+        url = str(extlink.url)
+        if "&" not in url and not self.url_prefilter_regex.match(url):
+            logger.debug("skipped unsupported URL: {}".format(extlink.url))
+            return
 
         # mwparserfromhell parses free URLs immediately followed by a template argument
         # (e.g. http://domain.tld/{{{1}}}) completely as one URL, so we can use this
         # to skip partial URLs inside templates
-        if url.filter_arguments(recursive=True):
+        if extlink.url.filter_arguments(recursive=True):
             return
 
         # mwparserfromhell parses free URLs immediately followed by a template
         # (e.g. http://domain.tld/{{Dead link|2020|02|20}}) completely as one URL,
         # so we need to split it manually
-        if "{{" in str(url):
+        if "{{" in url:
             # back up original wikicode
             text_old = str(wikicode)
 
-            url, rest = str(url).split("{{", maxsplit=1)
-            rest = "{{" + rest
-            url = mwparserfromhell.parse(url)
+            rest = "{{" + url.split("{{", maxsplit=1)[1]
             # find the index of the template in extlink.url.nodes
             # (note that it may be greater than 1, e.g. when there are HTML entities)
             for idx in range(len(extlink.url.nodes)):
@@ -100,19 +167,21 @@ class ExtlinkStatusChecker(CheckerBase):
             parent = get_parent_wikicode(wikicode, extlink)
             parent.insert_after(extlink, rest)
 
-            # make sure that this was a no-op
+            # make sure that this was a no-op (the diff is computed only on failure)
             text_new = str(wikicode)
-            diff = diff_highlighted(text_old, text_new, "old", "new", "<utcnow>", "<utcnow>")
-            assert text_old == text_new, "failed to fix parsing of templates after URL. The diff is:\n{}".format(diff)
+            assert text_old == text_new, "failed to fix parsing of templates after URL. The diff is:\n{}" \
+                                         .format(diff_highlighted(text_old, text_new, "old", "new", "<utcnow>", "<utcnow>"))
 
         # replace HTML entities like "&#61" or "&Sigma;" with their unicode equivalents
-        for entity in url.ifilter_html_entities(recursive=True):
-            url.replace(entity, entity.normalize())
+        # (extlink.url is not modified, the nodes are already parsed so there is no need
+        # to parse a copy of the URL)
+        url = "".join(node.normalize() if isinstance(node, mwparserfromhell.nodes.HTMLEntity) else str(node)
+                      for node in extlink.url.nodes)
 
         try:
             # try to parse the URL - fails e.g. if port is not a number
             # reference: https://urllib3.readthedocs.io/en/latest/reference/urllib3.util.html#urllib3.util.parse_url
-            url = urllib3.util.url.parse_url(str(url))
+            url = urllib3.util.url.parse_url(url)
         except urllib3.exceptions.LocationParseError:
             logger.debug("skipped invalid URL: {}".format(url))
             return
@@ -148,7 +217,179 @@ class ExtlinkStatusChecker(CheckerBase):
 
         return url
 
+    def release_response(self, response):
+        """
+        Release the connection of a streamed response back to the pool.
+
+        Closing a response with an unread body closes the underlying
+        connection, so the next request to the same host has to open a new
+        one. Hence small bodies (e.g. typical error pages) are read first so
+        that the connection can be kept alive. Larger bodies or bodies of
+        unknown size are discarded by closing the connection.
+        """
+        try:
+            length = int(response.headers.get("Content-Length", ""))
+        except ValueError:
+            length = None
+        if length is not None and length <= self.max_drain_size:
+            try:
+                # reading the content marks it as consumed
+                response.content
+            except requests.exceptions.RequestException:
+                pass
+        response.close()
+
+    def check_url_head(self, url, *, allow_redirects=True):
+        """
+        Try to check the URL with a HEAD request, which does not transfer the
+        response body.
+
+        Only successful responses are trusted, because many servers respond
+        incorrectly to HEAD requests. Hosts which reject HEAD requests, close
+        the connection or do not reply at all are added to :py:attr:`hosts_without_head`.
+
+        :returns: the response if the HEAD request succeeded or the server
+            responded with 429 (Too Many Requests), ``None`` if the URL has to
+            be checked with a GET request
+        :raises: exceptions that would not be fixed by a GET request (e.g.
+            connection timeouts or domain resolution errors) are propagated
+        """
+        try:
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=allow_redirects)
+            response.close()
+        # SSLError and ConnectTimeout inherit from ConnectionError so they have to be checked first
+        except (requests.exceptions.SSLError, requests.exceptions.ConnectTimeout, requests.exceptions.TooManyRedirects):
+            raise
+        except requests.exceptions.ReadTimeout:
+            # some servers do not reply at all to HEAD requests
+            self.hosts_without_head.add(url.host)
+            return None
+        except requests.exceptions.ConnectionError as e:
+            if "name or service not known" in str(e).lower():
+                raise
+            # e.g. the server closed the connection without a response
+            self.hosts_without_head.add(url.host)
+            return None
+        except requests.exceptions.RequestException:
+            self.hosts_without_head.add(url.host)
+            return None
+
+        # 405 Method Not Allowed, 501 Not Implemented
+        if response.status_code in {405, 501}:
+            self.hosts_without_head.add(url.host)
+            return None
+        # a GET request would be throttled too
+        if response.status_code == 429 or (response.status_code >= 200 and response.status_code < 300):
+            return response
+        return None
+
+    def host_semaphore(self, host):
+        """
+        Return the semaphore limiting the number of concurrent requests to the
+        given host.
+        """
+        with self.host_semaphores_lock:
+            semaphore = self.host_semaphores.get(host)
+            if semaphore is None:
+                limit = self.host_request_limits.get(host, self.max_requests_per_host)
+                semaphore = self.host_semaphores[host] = threading.BoundedSemaphore(limit)
+            return semaphore
+
+    def get_retry_after(self, response):
+        """
+        Return the delay (in seconds) requested by the ``Retry-After`` header of
+        the response, capped by :py:attr:`max_retry_after`.
+        """
+        value = response.headers.get("Retry-After", "").strip()
+        if value.isdigit():
+            delay = int(value)
+        else:
+            try:
+                date = email.utils.parsedate_to_datetime(value)
+                delay = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = self.default_retry_after
+        return min(max(delay, 0), self.max_retry_after)
+
+    def cache_db_init(self, path):
+        # the connection is shared by the threads of check_urls, access is synchronized with a lock
+        self.cache_db = sqlite3.connect(path, check_same_thread=False)
+        self.cache_db_lock = threading.Lock()
+        # pending rows which were not written to the database yet
+        self.cache_db_pending = []
+        with self.cache_db_lock, self.cache_db:
+            # status is 1 for valid, 0 for invalid and NULL for indeterminate URLs
+            self.cache_db.execute("CREATE TABLE IF NOT EXISTS url_status ("
+                                  "url TEXT PRIMARY KEY, "
+                                  "status INTEGER, "
+                                  "reason TEXT, "
+                                  "checked_at INTEGER NOT NULL)")
+
+    def cache_db_load(self, url):
+        """
+        Load the status of the URL from the persistent cache into the in-memory
+        caches.
+
+        :returns: ``True`` if a result which is not older than
+            ``cache_max_age`` was found, ``False`` otherwise
+        """
+        if self.cache_db is None:
+            return False
+        min_checked_at = int(time.time() - self.cache_max_age.total_seconds())
+        with self.cache_db_lock:
+            row = self.cache_db.execute("SELECT status, reason FROM url_status WHERE url = ? AND checked_at >= ?",
+                                        (url.url, min_checked_at)).fetchone()
+        if row is None:
+            return False
+        status, reason = row
+        if status == 1:
+            self.cache_valid_urls.add(url)
+        elif status == 0:
+            self.cache_invalid_urls[url] = reason
+        else:
+            self.cache_indeterminate_urls.add(url)
+        return True
+
+    def cache_db_store(self, url):
+        """
+        Schedule the status of the URL from the in-memory caches to be written
+        into the persistent cache by :py:meth:`cache_db_flush`.
+        """
+        if self.cache_db is None:
+            return
+        if url in self.cache_valid_urls:
+            status, reason = 1, None
+        elif url in self.cache_invalid_urls:
+            status, reason = 0, str(self.cache_invalid_urls[url])
+        elif url in self.cache_indeterminate_urls:
+            status, reason = None, None
+        else:
+            # the result was not cached (e.g. connection error)
+            return
+        checked_at = int(time.time())
+        with self.cache_db_lock:
+            self.cache_db_pending.append((url.url, status, reason, checked_at))
+
+    def cache_db_flush(self):
+        """
+        Write all pending results into the persistent cache in one transaction.
+        """
+        if self.cache_db is None:
+            return
+        with self.cache_db_lock:
+            if not self.cache_db_pending:
+                return
+            with self.cache_db:
+                self.cache_db.executemany("INSERT OR REPLACE INTO url_status (url, status, reason, checked_at) VALUES (?, ?, ?, ?)",
+                                          self.cache_db_pending)
+            self.cache_db_pending = []
+
     def check_url(self, url, *, allow_redirects=True):
+        status = self._check_url(url, allow_redirects=allow_redirects)
+        self.cache_db_flush()
+        return status
+
+    def _check_url(self, url, *, allow_redirects=True):
         if not isinstance(url, urllib3.util.url.Url):
             url = urllib3.util.url.parse_url(url)
 
@@ -156,22 +397,79 @@ class ExtlinkStatusChecker(CheckerBase):
         if url.fragment:
             url = urllib3.util.url.parse_url(url.url.rsplit("#", maxsplit=1)[0])
 
-        # check the caches
+        # check the in-memory caches
+        if self.is_url_cached(url):
+            return self.get_cached_status(url)
+
+        # make sure that only one thread checks the same URL, others wait for its result
+        with self.inflight_urls_lock:
+            # the URL might have been checked since the first test
+            if self.is_url_cached(url):
+                return self.get_cached_status(url)
+            future = self.inflight_urls.get(url)
+            is_owner = future is None
+            if is_owner:
+                future = self.inflight_urls[url] = concurrent.futures.Future()
+        if not is_owner:
+            return future.result()
+
+        try:
+            # the persistent cache is loaded into the in-memory caches
+            if self.cache_db_load(url):
+                status = self.get_cached_status(url)
+            else:
+                status = self.request_url_status(url, allow_redirects=allow_redirects)
+                self.cache_db_store(url)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(status)
+        finally:
+            with self.inflight_urls_lock:
+                del self.inflight_urls[url]
+        return status
+
+    def is_url_cached(self, url):
+        return url in self.cache_valid_urls or url in self.cache_invalid_urls or url in self.cache_indeterminate_urls
+
+    def get_cached_status(self, url):
         if url in self.cache_valid_urls:
             return True
         elif url in self.cache_invalid_urls:
             return False
-        elif url in self.cache_indeterminate_urls:
+        else:
             return None
 
-        try:
+    def send_request(self, url, *, allow_redirects=True):
+        head_tried = url.host not in self.hosts_without_head
+        response = None
+        if head_tried:
+            response = self.check_url_head(url, allow_redirects=allow_redirects)
+        if response is None:
             # We need to use GET requests instead of HEAD, because many servers just return 404
             # (or do not reply at all) to HEAD requests. Instead, we skip the downloading of the
             # response body content using the ``stream=True`` parameter.
-            response = self.session.get(url, headers=self.headers, timeout=self.timeout, stream=True, allow_redirects=allow_redirects)
-            # explicitly close the responses to release the connection back to the pool
+            response = self.session.get(url, timeout=self.timeout, stream=True, allow_redirects=allow_redirects)
+            # explicitly release the connection back to the pool
             # (this is important, especially when we use pool_block=True)
-            response.close()
+            self.release_response(response)
+            if head_tried and response.status_code >= 200 and response.status_code < 300:
+                # the HEAD request failed, but GET succeeded
+                self.hosts_without_head.add(url.host)
+        return response
+
+    def request_url_status(self, url, *, allow_redirects=True):
+        try:
+            with self.host_semaphore(url.host):
+                response = self.send_request(url, allow_redirects=allow_redirects)
+                if response.status_code == 429:
+                    # retry once after the requested delay (the semaphore is held
+                    # while sleeping to throttle other requests to the same host)
+                    delay = self.get_retry_after(response)
+                    logger.info("status code 429 for URL {}, retrying after {} seconds".format(url, delay))
+                    time.sleep(delay)
+                    response = self.send_request(url, allow_redirects=allow_redirects)
         # SSLError inherits from ConnectionError so it has to be checked first
         except requests.exceptions.SSLError as e:
             logger.error("SSLError ({}) for URL {}".format(e, url))
@@ -197,6 +495,12 @@ class ExtlinkStatusChecker(CheckerBase):
         if response.status_code >= 200 and response.status_code < 300:
             self.cache_valid_urls.add(url)
             return True
+        elif response.status_code == 429:
+            # Too Many Requests even after the retry - indeterminate, cached to avoid
+            # repeating the retry for the same URL
+            logger.warning("status code 429 for URL {}".format(url))
+            self.cache_indeterminate_urls.add(url)
+            return None
         elif response.status_code >= 400 and response.status_code < 500:
             # detect cloudflare captcha https://github.com/pielco11/fav-up/issues/13
             if "CF-Chl-Bypass" in response.headers:
@@ -211,14 +515,74 @@ class ExtlinkStatusChecker(CheckerBase):
             self.cache_indeterminate_urls.add(url)
             return None
 
+    def check_urls(self, urls, *, allow_redirects=True):
+        """
+        Check the status of multiple URLs concurrently.
+
+        The URLs are checked like in :py:meth:`check_url` in a thread pool, so
+        the requests share the session and the URL status caches. The number of
+        concurrent requests per host is limited by :py:meth:`host_semaphore`
+        and by the size of the connection pool (``max_connections_per_host``).
+        The URLs are interleaved by host so that the workers are not all
+        blocked on the same host.
+
+        :param urls: an iterable of URLs (either strings or
+            :py:class:`urllib3.util.url.Url` objects)
+        :returns: a list of statuses as returned by :py:meth:`check_url`, in
+            the same order as ``urls``
+        """
+        urls = list(urls)
+
+        def check(url):
+            return self._check_url(url, allow_redirects=allow_redirects)
+
+        if len(urls) < 2 or self.max_workers < 2:
+            statuses = [check(url) for url in urls]
+        else:
+            # order the URLs round-robin by host
+            by_host = {}
+            for i, url in enumerate(urls):
+                host = url.host if isinstance(url, urllib3.util.url.Url) else urllib3.util.url.parse_url(url).host
+                by_host.setdefault(host, []).append(i)
+            order = [i for group in itertools.zip_longest(*by_host.values()) for i in group if i is not None]
+
+            statuses = [None] * len(urls)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for i, status in zip(order, executor.map(check, (urls[i] for i in order))):
+                    statuses[i] = status
+
+        # write the results of the whole batch into the persistent cache at once
+        self.cache_db_flush()
+        return statuses
+
+    def prepare_page(self, src_title, wikicode):
+        # check all external links on the page at once, the results are stored
+        # in page_url_statuses and picked up by check_extlink_status for each node
+        urls = []
+        with self.lock_wikicode:
+            for extlink in wikicode.ifilter_external_links(recursive=True):
+                url = self.prepare_url(wikicode, extlink)
+                if url is not None:
+                    urls.append(url)
+        # deduplicate and keep order
+        urls = list(dict.fromkeys(urls))
+        self.page_url_statuses = {}
+        if urls:
+            logger.info("Checking {} links on page [[{}]] ...".format(len(urls), src_title))
+            self.page_url_statuses = dict(zip(urls, self.check_urls(urls)))
+
     def check_extlink_status(self, wikicode, extlink, src_title):
         with self.lock_wikicode:
             url = self.prepare_url(wikicode, extlink)
         if url is None:
             return
 
-        logger.info("Checking link {} ...".format(extlink))
-        status = self.check_url(url)
+        if url in self.page_url_statuses:
+            # already checked by prepare_page
+            status = self.page_url_statuses[url]
+        else:
+            logger.info("Checking link {} ...".format(extlink))
+            status = self.check_url(url)
 
         with self.lock_wikicode:
             if status is True:
@@ -231,7 +595,8 @@ class ExtlinkStatusChecker(CheckerBase):
                 flag = self.get_localized_template("Dead link", lang.detect_language(src_title)[1])
                 localize_flag(wikicode, extlink, flag)
                 # flag the link, but don't overwrite date and don't set status yet
-                flag = ensure_flagged_by_template(wikicode, extlink, flag, *self.deadlink_params, overwrite_parameters=False)
+                deadlink_params = self.deadlink_params
+                flag = ensure_flagged_by_template(wikicode, extlink, flag, *deadlink_params, overwrite_parameters=False)
                 # drop the fragment from the URL before looking into the cache
                 if url.fragment:
                     url = urllib3.util.url.parse_url(url.url.rsplit("#", maxsplit=1)[0])
@@ -244,9 +609,9 @@ class ExtlinkStatusChecker(CheckerBase):
                 if overwrite is True:
                     # overwrite status as well as date
                     flag.add("status", self.cache_invalid_urls[url], showkey=True)
-                    flag.add("1", self.deadlink_params[0], showkey=False)
-                    flag.add("2", self.deadlink_params[1], showkey=False)
-                    flag.add("3", self.deadlink_params[2], showkey=False)
+                    flag.add("1", deadlink_params[0], showkey=False)
+                    flag.add("2", deadlink_params[1], showkey=False)
+                    flag.add("3", deadlink_params[2], showkey=False)
             else:
                 # TODO: ask the user for manual check (good/bad/skip) and move the URL from self.cache_indeterminate_urls to self.cache_valid_urls or self.cache_invalid_urls
                 logger.warning("status check indeterminate for external link {}".format(extlink))
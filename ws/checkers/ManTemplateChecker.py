@@ -1,7 +1,5 @@
 #! /usr/bin/env python3
 
-import datetime
-
 import mwparserfromhell
 
 from .CheckerBase import get_edit_summary_tracker, localize_flag
@@ -24,9 +22,7 @@ class ManTemplateChecker(ExtlinkStatusChecker):
             return
         src_lang = lang.detect_language(src_title)[1]
 
-        now = datetime.datetime.utcnow()
-        deadlink_params = [now.year, now.month, now.day]
-        deadlink_params = ["{:02d}".format(i) for i in deadlink_params]
+        deadlink_params = self.deadlink_params
 
         if not template.has(1) or not template.has(2, ignore_empty=True):
             # first replace the existing template (if any) with a translated version
@@ -43,6 +39,7 @@ class ManTemplateChecker(ExtlinkStatusChecker):
         # template parameter 1= should be empty
         if not template.has(1, ignore_empty=True):
             response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            response.close()
             # heuristics to get the missing section (redirect from some_page to some_page.1)
             # WARNING: if the manual exists in multiple sections, the first one might not be the best
             if response.status_code == 200 and len(response.history) == 1 and response.url.startswith(url + "."):
@@ -79,6 +76,10 @@ class ManTemplateChecker(ExtlinkStatusChecker):
                 # flag with the correct translated template
                 ensure_flagged_by_template(wikicode, template, flag, *deadlink_params, overwrite_parameters=False)
 
+    def prepare_page(self, src_title, wikicode):
+        # this checker checks only the URLs generated from the man templates
+        pass
+
     def handle_node(self, src_title, wikicode, node, summary_parts):
         if isinstance(node, mwparserfromhell.nodes.Template):
             summary = get_edit_summary_tracker(wikicode, summary_parts)
@@ -140,6 +140,15 @@ class PageUpdater:
         wikicode = mwparserfromhell.parse(text, skip_style_tags=True)
         summary_parts = []
 
+        # let each registered checker prepare for the page (exactly once, even
+        # when it is registered for multiple node types)
+        prepared = []
+        for checkers in self.checkers.values():
+            for checker in checkers:
+                if checker not in prepared:
+                    checker.prepare_page(src_title, wikicode)
+                    prepared.append(checker)
+
         def gen_nodes():
             for node_type, checkers in self.checkers.items():
                 for node in wikicode.ifilter(recursive=True, forcetype=node_type):
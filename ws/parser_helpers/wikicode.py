@@ -54,6 +54,11 @@ def get_parent_wikicode(wikicode, node):
     Returns the parent of `node` as a `wikicode` object.
     Raises :exc:`ValueError` if `node` is not a descendant of `wikicode`.
     """
+    # fast path for direct children, which avoids walking all descendants
+    # of the preceding nodes
+    for child in wikicode.nodes:
+        if child is node:
+            return wikicode
     context, index = wikicode._do_strong_search(node, True)
     return context
 
@@ -24,10 +24,12 @@ class TLSAdapter(requests.adapters.HTTPAdapter):
         self.ssl_options = ssl_options
         super(TLSAdapter, self).__init__(**kwargs)
 
-    def init_poolmanager(self, *pool_args, **pool_kwargs):
+    def init_poolmanager(self, connections, maxsize, block=requests.adapters.DEFAULT_POOLBLOCK, **pool_kwargs):
         ctx = ssl_.create_urllib3_context(ssl.PROTOCOL_TLS)
         # extend the default context options, which is to disable SSL2, SSL3
         # and SSL compression, see:
         # https://github.com/shazow/urllib3/blob/6a6cfe9/urllib3/util/ssl_.py#L241
         ctx.options |= self.ssl_options
-        self.poolmanager = PoolManager(*pool_args, ssl_context=ctx, **pool_kwargs)
+        # the pool parameters have to be passed by keyword, the positional
+        # arguments of PoolManager are (num_pools, headers, **connection_pool_kw)
+        self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize, block=block, ssl_context=ctx, **pool_kwargs)